@@ -1,14 +1,77 @@
 #!/usr/bin/env python3
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
 import argparse
+import asyncio
+import collections
 import csv
+import functools
+import heapq
+import itertools
+import json
+import multiprocessing
+import os
+import queue
+import dns.entropy
+import dns.exception
+import dns.flags
 import dns.name
 import dns.message
-import dns.query
 import dns.rdatatype
 import dns.rcode
+import random
 import socket
+import statistics
+import struct
+import sys
+import time
+
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+UDP_SOCKETS = 8  # ephemeral source ports queries are spread across
+SOCKET_BUFFER_SIZE = 4 << 20  # capped by net.core.rmem_max / wmem_max
+EDNS_PAYLOAD = 1232  # DNS Flag Day 2020: avoids IP fragmentation
+TCP_POOL_SIZE = 32  # persistent TCP connections kept open, least recently used closed first
+RESOLVER_CONCURRENCY = 50  # initial in-flight UDP queries allowed per resolver
+RESOLVER_MIN_CONCURRENCY = 8  # floor a resolver's limit is never halved below
+RESOLVER_FAILURES = (dns.rcode.SERVFAIL, dns.rcode.REFUSED)  # rcodes counted against a resolver
+AIMD_INCREASE_EVERY = 100  # successes per +1 on a resolver's limit
+AIMD_WINDOW = 100  # queries per failure-rate check
+AIMD_FAILURE_RATE = 0.5  # share of failed queries in a window that halves the limit
+AIMD_COOLDOWN = 1.0  # seconds between halvings of a resolver's limit
+AIMD_MIN_HOLD = 0.25  # seconds an unanswered query holds its slot, at least
+RECV_BATCH = 256  # datagrams read per socket wakeup before yielding to other tasks
+TCP_IDLE_TIMEOUT = 10.0  # seconds an unused pooled TCP connection stays open
+RETRY_BACKOFF = 0.05  # seconds before the first retry, doubled for each one after
+PROBE_DOMAIN = "example.com"
+PROBE_COUNT = 3  # probe queries per resolver when ranking
+SHARD_SIZE = 1000  # domains handed to a worker process at a time
+RESULT_BATCH = 256  # records a worker process sends back at a time
+
+def positive_int(value):
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be a positive integer: {value}")
+    return number
+
+def non_negative_int(value):
+    number = int(value)
+    if number < 0:
+        raise argparse.ArgumentTypeError(f"must be a non-negative integer: {value}")
+    return number
+
+def positive_float(value):
+    number = float(value)
+    if not number > 0:
+        raise argparse.ArgumentTypeError(f"must be a positive number: {value}")
+    return number
 
 def parse_args():
     parser = argparse.ArgumentParser(description="Diglet: Parallel DNS querying with resolver rotation and retry logic")
@@ -16,87 +79,671 @@ def parse_args():
     parser.add_argument("-r", "--resolvers", default="resolvers.txt", help="Path to resolvers file (default: resolvers.txt)")
     parser.add_argument("-q", "--quiet", action="store_true", help="Suppress output to stdout")
     parser.add_argument("-t", "--types", default="A", help="Comma-separated list of DNS record types to fetch (e.g., A,MX,TXT)")
-    parser.add_argument("-w", "--workers", type=int, default=100, help="Number of concurrent workers (default: 100)")
+    parser.add_argument("-w", "--workers", type=positive_int, default=1000, help="Maximum number of in-flight queries (default: 1000)")
+    parser.add_argument("-p", "--processes", type=positive_int, default=1, help="Number of worker processes to shard domains across (default: 1)")
     parser.add_argument("-o", "--output", help="CSV output file path")
+    parser.add_argument("-f", "--format", choices=("text", "jsonl"), default="text", help="Format of stdout output (default: text)")
+    parser.add_argument("--retries", type=positive_int, default=3, help="Maximum attempts per query, rotating resolvers (default: 3)")
+    parser.add_argument("--replicate", type=positive_int, default=1, help="Send each attempt to this many resolvers at once and keep the first answer (default: 1)")
+    parser.add_argument("--timeout", type=positive_float, default=1.0, help="Initial per-attempt timeout in seconds, doubled on each retry (default: 1.0)")
+    parser.add_argument("--rank", type=non_negative_int, default=0, help="Probe resolvers and rotate among the N fastest, weighted by speed (default: 0, off)")
+    parser.add_argument("--reprobe-interval", type=float, default=0, help="Seconds between re-probing resolvers when ranking (default: 0, never)")
     return parser.parse_args()
 
 def load_list(path):
     with open(path) as f:
-        return [line.strip() for line in f if line.strip()]
+        data = f.read()
+    # dict.fromkeys drops repeated entries while keeping first-seen order
+    return list(dict.fromkeys(line for line in map(str.strip, data.splitlines()) if line))
+
+def load_resolvers(path):
+    # Parsed once into the (ip, port) tuples used as sendto() addresses and
+    # matched against reply source addresses, so both IPv4 and IPv6 entries
+    # are normalised to the form recvfrom() reports.
+    resolvers = []
+    for ip in load_list(path):
+        for family in (socket.AF_INET, socket.AF_INET6):
+            try:
+                packed = socket.inet_pton(family, ip)
+            except OSError:
+                continue
+            resolvers.append((socket.inet_ntop(family, packed), 53))
+            break
+        else:
+            raise ValueError(f"Invalid resolver address: {ip}")
+    return resolvers
+
+class TCPConnection:
+    # A pipelined TCP connection (RFC 7766): queries are written as soon as
+    # they arrive and replies, which may come back in any order, are matched
+    # to their query by transaction ID.
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.pending = {}
+        self.answered = 0
+        self.idle = None
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @property
+    def closed(self):
+        return self.receiver.done()
+
+    async def receive(self):
+        try:
+            while True:
+                length, = struct.unpack("!H", await self.reader.readexactly(2))
+                data = await self.reader.readexactly(length)
+                entry = self.pending.get(int.from_bytes(data[:2], "big"))
+                if entry is None or entry[0].done():
+                    continue
+                future, request = entry
+                response = parse_response(request, data)
+                if response is not None:
+                    future.set_result(response)
+                    self.answered += 1
+        except (EOFError, ConnectionError):
+            pass
+        finally:
+            self.writer.close()
+            for future, _ in self.pending.values():
+                if not future.done():
+                    future.set_exception(EOFError("connection closed"))
+
+    async def query(self, request, wire, timeout):
+        txid = dns.entropy.random_16()
+        while txid in self.pending:
+            txid = dns.entropy.random_16()
+        packet = bytearray(struct.pack("!H", len(wire)) + wire)
+        struct.pack_into("!H", packet, 2, txid)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[txid] = (future, request)
+        if self.idle is not None:
+            self.idle.cancel()
+            self.idle = None
+        try:
+            self.writer.write(packet)
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=timeout)
+        finally:
+            del self.pending[txid]
+            if not self.pending and not self.closed:
+                self.idle = asyncio.get_running_loop().call_later(TCP_IDLE_TIMEOUT, self.close)
+
+    def close(self):
+        self.receiver.cancel()
+        self.writer.close()
+
+class TCPPool:
+    # Persistent TCP connections for truncated answers, one per resolver, so
+    # only the first fallback to a resolver pays for the handshake and all
+    # later ones share the connection concurrently.
+    def __init__(self, max_size=TCP_POOL_SIZE):
+        self.max_size = max_size
+        self.connections = collections.OrderedDict()
+        self.locks = collections.defaultdict(asyncio.Lock)
+
+    async def connect(self, resolver_addr, timeout):
+        async with self.locks[resolver_addr]:
+            connection = self.connections.pop(resolver_addr, None)
+            if connection is None or connection.closed:
+                try:
+                    streams = await asyncio.wait_for(asyncio.open_connection(*resolver_addr), timeout)
+                except asyncio.TimeoutError:
+                    raise dns.exception.Timeout(timeout=timeout)
+                connection = TCPConnection(*streams)
+                while len(self.connections) >= self.max_size:
+                    _, evicted = self.connections.popitem(last=False)
+                    evicted.close()
+            self.connections[resolver_addr] = connection
+            return connection
+
+    async def query(self, request, wire, resolver_addr, timeout):
+        connection = await self.connect(resolver_addr, timeout)
+        try:
+            return await connection.query(request, wire, timeout)
+        except (EOFError, ConnectionError):
+            # Resolvers drop idle connections, so a failure on one that had
+            # already served queries gets one more try on a fresh one.
+            if not connection.answered:
+                raise
+            connection = await self.connect(resolver_addr, timeout)
+            return await connection.query(request, wire, timeout)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+class AdaptiveLimit:
+    # Caps in-flight queries to one resolver and adapts the cap AIMD-style:
+    # +1 after every AIMD_INCREASE_EVERY answers, halved (at most once per
+    # AIMD_COOLDOWN, never below RESOLVER_MIN_CONCURRENCY) when at least
+    # AIMD_FAILURE_RATE of the last AIMD_WINDOW queries timed out or came back
+    # SERVFAIL/REFUSED. Judging the rate, not single timeouts, keeps a few
+    # dead names from being mistaken for an overloaded resolver.
+    def __init__(self, limit=RESOLVER_CONCURRENCY):
+        self.limit = limit
+        self.active = 0
+        self.successes = 0
+        self.outcomes = 0
+        self.failures = 0
+        self.srtt = None
+        self.last_decrease = 0.0
+        self.waiters = collections.deque()
+
+    async def acquire(self):
+        while self.active >= self.limit:
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                self.wake()  # pass on a wakeup this waiter may have consumed
+                raise
+        self.active += 1
+
+    def hold_time(self, timeout):
+        # How long a query counts against the limit: one still unanswered
+        # after a few smoothed round trips is more likely stuck on a dead name
+        # than queued at a busy resolver, so it stops taking up a slot.
+        if self.srtt is None:
+            return timeout
+        return min(timeout, max(AIMD_MIN_HOLD, 4 * self.srtt))
+
+    def release(self):
+        self.active -= 1
+        self.wake()
+
+    def record(self, outcome, rtt=None):
+        if outcome == "answer":
+            self.srtt = rtt if self.srtt is None else self.srtt + (rtt - self.srtt) / 8
+            self.successes += 1
+            if self.successes >= AIMD_INCREASE_EVERY:
+                self.limit += 1
+                self.successes = 0
+        else:
+            self.failures += 1
+        self.outcomes += 1
+        if self.outcomes < AIMD_WINDOW:
+            return
+        now = time.monotonic()
+        if self.failures >= AIMD_FAILURE_RATE * self.outcomes and now - self.last_decrease >= AIMD_COOLDOWN:
+            self.limit = max(RESOLVER_MIN_CONCURRENCY, self.limit // 2)
+            self.last_decrease = now
+            self.successes = 0
+        self.outcomes = self.failures = 0
+
+    def wake(self):
+        free = self.limit - self.active
+        while free > 0 and self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+class DNSTransport:
+    # A small pool of long-lived UDP sockets per address family, shared by
+    # every in-flight query; each query goes out on a random one, so source
+    # ports vary as well as transaction IDs. Replies are matched to their
+    # query by (transaction ID, resolver address) and only consume it once
+    # they parse and carry the right question, so a stray or spoofed datagram
+    # cannot cut a query short. Each readiness wakeup drains up to RECV_BATCH
+    # queued datagrams.
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.channels = {}  # address family -> [(socket, pending queries)]
+        self.limits = collections.defaultdict(AdaptiveLimit)
+        self.tcp = TCPPool()
+
+    def open_channels(self, family):
+        # Sockets for a family are only opened once a resolver needs them,
+        # so IPv4-only runs never touch IPv6 and vice versa. If any of them
+        # fails to open (e.g. IPv6 disabled), none are kept.
+        sockets = []
+        try:
+            for _ in range(UDP_SOCKETS):
+                sockets.append(open_socket(family))
+        except OSError:
+            for sock in sockets:
+                sock.close()
+            raise
+        channels = []
+        for sock in sockets:
+            pending = {}
+            self.loop.add_reader(sock.fileno(), self.drain, sock, pending)
+            channels.append((sock, pending))
+        self.channels[family] = channels
+        return channels
+
+    def drain(self, sock, pending):
+        for _ in range(RECV_BATCH):
+            try:
+                data, addr = sock.recvfrom(65535)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                continue  # e.g. ICMP port unreachable; the affected query simply times out
+            # IPv6 source addresses carry flowinfo and scope ID as well
+            entry = pending.get((int.from_bytes(data[:2], "big"), addr[:2]))
+            if entry is None or entry[0].done():
+                continue
+            future, request = entry
+            response = parse_response(request, data)
+            if response is not None:
+                future.set_result(response)
+
+    async def query(self, request, wire, resolver_addr, timeout):
+        family = socket.AF_INET6 if ":" in resolver_addr[0] else socket.AF_INET
+        channels = self.channels.get(family) or self.open_channels(family)
+        sock, pending = random.choice(channels)
+        limit = self.limits[resolver_addr]
+        # Anything that can fail, like opening sockets above, happens before
+        # a slot is taken, so every acquired slot reaches the release below.
+        await limit.acquire()
+        txid = dns.entropy.random_16()
+        while (txid, resolver_addr) in pending:
+            txid = dns.entropy.random_16()
+        packet = bytearray(wire)
+        struct.pack_into("!H", packet, 0, txid)
+        key = (txid, resolver_addr)
+        future = self.loop.create_future()
+        pending[key] = (future, request)
+        held = True
+
+        def lapse():
+            nonlocal held
+            held = False
+            limit.release()
+
+        lapsed = self.loop.call_later(limit.hold_time(timeout), lapse)
+        start = self.loop.time()
+        outcome = None
+        try:
+            sock.sendto(packet, resolver_addr)
+            response = await asyncio.wait_for(future, timeout)
+            outcome = "failure" if response.rcode() in RESOLVER_FAILURES else "answer"
+            return response
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise dns.exception.Timeout(timeout=timeout)
+        finally:
+            del pending[key]
+            lapsed.cancel()
+            if outcome is not None:
+                limit.record(outcome, self.loop.time() - start)
+            if held:
+                limit.release()
+
+    def close(self):
+        for channels in self.channels.values():
+            for sock, _ in channels:
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+        self.tcp.close()
+
+def open_socket(family):
+    sock = socket.socket(family, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER_SIZE)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER_SIZE)
+    sock.setblocking(False)
+    sock.bind(("::" if family == socket.AF_INET6 else "0.0.0.0", 0))
+    return sock
+
+# Each record type is parsed once for the whole run.
+rdatatype_from_text = functools.lru_cache(maxsize=None)(dns.rdatatype.from_text)
 
-def fetch_dns(domain, resolver_ip, record_type='A', timeout=10):
+def make_query(domain, record_type):
+    # Built once per (domain, type) by the task resolving it and reused across
+    # its retries; the transport only rewrites the transaction ID in a copy of
+    # the wire bytes.
     qname = dns.name.from_text(domain)
-    qtype = dns.rdatatype.from_text(record_type)
+    qtype = rdatatype_from_text(record_type)
+    request = dns.message.make_query(qname, qtype, use_edns=0, payload=EDNS_PAYLOAD)
+    return request, request.to_wire()
+
+def parse_response(request, data):
+    # The reply to `request`, or None for anything that does not parse or
+    # answers a different question.
+    try:
+        response = dns.message.from_wire(data)
+    except dns.exception.DNSException:
+        return None
+    if not response.flags & dns.flags.QR or response.question != request.question:
+        return None
+    return response
+
+async def fetch_dns(transport, request, wire, resolver_addr, timeout=10):
     try:
-        request = dns.message.make_query(qname, qtype)
-        response = dns.query.udp(request, resolver_ip, timeout=timeout)
+        response = await transport.query(request, wire, resolver_addr, timeout)
+        if response.flags & dns.flags.TC:
+            response = await transport.tcp.query(request, wire, resolver_addr, timeout)
+        if response.rcode() in RESOLVER_FAILURES:
+            return None  # the resolver's failure, not the domain's: try another
         if response.rcode() == dns.rcode.NXDOMAIN:
             return 'NXDOMAIN'
         if response.answer:
             return [r.to_text() for rrset in response.answer for r in rrset]
         return []
-    except (dns.exception.Timeout, dns.exception.DNSException, socket.error):
+    except (dns.exception.Timeout, dns.exception.DNSException, socket.error, EOFError):
         return None
 
-def resolve_records(domains, resolvers, record_types, max_workers=100, max_retries=10):
-    def task(domain, rtype):
-        attempts = 0
-        for resolver_ip in resolvers:
-            result = fetch_dns(domain, resolver_ip, rtype)
+async def fetch_first(transport, request, wire, resolver_addrs, timeout=10):
+    # Races the same query against several resolvers and keeps the first
+    # answer, so one slow resolver cannot hold up the result. NXDOMAIN only
+    # wins once no other resolver has an answer; SERVFAIL/REFUSED never win.
+    if len(resolver_addrs) == 1:
+        return await fetch_dns(transport, request, wire, resolver_addrs[0], timeout)
+    pending = {asyncio.create_task(fetch_dns(transport, request, wire, addr, timeout)) for addr in resolver_addrs}
+    outcome = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for job in done:
+                result = job.result()
+                if result == 'NXDOMAIN':
+                    outcome = result
+                elif result is not None:
+                    return result
+        return outcome
+    finally:
+        for job in pending:
+            job.cancel()
+
+class ResolverRanking:
+    # Hands out per-query resolver orders. Unranked, every resolver is equally
+    # likely; once probed, orders are drawn from the `top` fastest resolvers
+    # with odds inversely proportional to their median response time. Only a
+    # NOERROR reply counts as an answer: a resolver that refuses or fails the
+    # probe is scored as if it had timed out.
+    def __init__(self, resolvers, top=0):
+        self.resolvers = resolvers
+        self.top = top
+        self.fastest = resolvers
+        self.latency = None
+
+    async def probe(self, transport, timeout=1.0):
+        request, wire = make_query(PROBE_DOMAIN, "A")
+
+        async def measure(resolver_addr):
+            samples = []
+            for _ in range(PROBE_COUNT):
+                start = time.monotonic()
+                try:
+                    response = await transport.query(request, wire, resolver_addr, timeout)
+                except (dns.exception.DNSException, socket.error):
+                    return timeout  # no point waiting out the remaining probes
+                if response.rcode() != dns.rcode.NOERROR:
+                    return timeout
+                samples.append(time.monotonic() - start)
+            return statistics.median(samples)
+
+        latencies = await asyncio.gather(*(measure(addr) for addr in self.resolvers))
+        self.latency = dict(zip(self.resolvers, latencies))
+        self.fastest = sorted(self.resolvers, key=self.latency.get)[:self.top]
+
+    def sample(self, k):
+        if self.latency is None:
+            return random.sample(self.resolvers, min(k, len(self.resolvers)))
+        # Weighted sampling without replacement (Efraimidis-Spirakis) with
+        # weight 1/latency, i.e. key u ** latency.
+        return heapq.nlargest(min(k, len(self.fastest)), self.fastest,
+                              key=lambda addr: random.random() ** self.latency[addr])
+
+async def stream(items):
+    # Plain iterables as async ones, so callers can pass either
+    if hasattr(items, "__aiter__"):
+        async for item in items:
+            yield item
+    else:
+        for item in items:
+            yield item
+
+async def resolve_records(domains, resolvers, record_types, max_workers=1000, max_retries=3, timeout=1.0, replicate=1,
+                          rank=0, reprobe_interval=0, ranking=None):
+    # Yields each domain's record as soon as all of its types have resolved.
+    # Queries are only started as in-flight slots free up, so memory grows
+    # with max_workers rather than with the number of domains. `domains` may
+    # be a list or an async stream of unknown length. A ranking probed
+    # elsewhere (e.g. by resolve_sharded) can be passed in as is.
+    semaphore = asyncio.Semaphore(max_workers)
+    completed = asyncio.Queue()
+    running = set()
+    transport = DNSTransport()
+    if ranking is None:
+        ranking = ResolverRanking(resolvers, rank)
+        if rank:
+            await ranking.probe(transport, timeout)
+
+    async def reprobe():
+        while True:
+            await asyncio.sleep(reprobe_interval)
+            await ranking.probe(transport, timeout)
+
+    async def resolve(domain, rtype):
+        # A random (or speed-weighted) order spreads first attempts across
+        # resolvers, and a timeout, SERVFAIL or REFUSED moves on to the next
+        # one; the timeout doubles per attempt (capped at 8x) so dead domains
+        # give up quickly while slow resolvers still get a fair chance.
+        request, wire = make_query(domain, rtype)
+        order = ranking.sample(max_retries * replicate)
+        targets = itertools.cycle(order)
+        for attempt in range(max_retries):
+            if attempt:
+                await asyncio.sleep(RETRY_BACKOFF * 2 ** (attempt - 1))
+            group = list(itertools.islice(targets, min(replicate, len(order))))
+            result = await fetch_first(transport, request, wire, group, timeout * 2 ** min(attempt, 3))
             if result == 'NXDOMAIN':
-                return domain, rtype, []  # stop retrying
+                return []  # stop retrying
             if result is not None:
-                return domain, rtype, result  # successful fetch or empty (no retry)
-            attempts += 1
-            if attempts >= max_retries:
-                break
-        return domain, rtype, []  # all attempts failed
+                return result  # answer, or NOERROR with no records (no retry)
+        return []  # all attempts failed
 
-    jobs = []
-    results = {}
+    async def task(idx, domain, rtype):
+        try:
+            return idx, domain, rtype, await resolve(domain, rtype)
+        finally:
+            semaphore.release()
 
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        for domain in domains:
+    submitted = 0
+
+    async def submit():
+        nonlocal submitted
+        idx = 0
+        async for domain in stream(domains):
             for rtype in record_types:
-                jobs.append(executor.submit(task, domain, rtype))
+                await semaphore.acquire()
+                job = asyncio.create_task(task(idx, domain, rtype))
+                running.add(job)
+                job.add_done_callback(running.discard)
+                job.add_done_callback(completed.put_nowait)
+                submitted += 1
+            idx += 1
+        completed.put_nowait(None)  # every job has been submitted
+
+    producer = asyncio.create_task(submit())
+    prober = asyncio.create_task(reprobe()) if rank and reprobe_interval > 0 else None
+    records = {}
+    received = 0
+    exhausted = False
+    try:
+        while not exhausted or received < submitted:
+            job = await completed.get()
+            if job is None:
+                exhausted = True
+                continue
+            received += 1
+            idx, domain, rtype, result = job.result()
+            record = records.setdefault(idx, {"domain": domain})
+            record[rtype] = result
+            if len(record) > len(record_types):
+                del records[idx]
+                yield record
+    finally:
+        producer.cancel()
+        if prober is not None:
+            prober.cancel()
+        for job in running:
+            job.cancel()
+        transport.close()
+
+def pin_worker(index):
+    # Give each worker process a CPU of its own, round-robin over the CPUs
+    # this process may run on.
+    if hasattr(os, "sched_setaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+        os.sched_setaffinity(0, {cpus[index % len(cpus)]})
 
-        for future in as_completed(jobs):
-            domain, rtype, result = future.result()
-            if domain not in results:
-                results[domain] = {"domain": domain}
-            results[domain][rtype] = result
+def resolve_worker(index, shards, results, resolvers, record_types, options):
+    # Runs in a worker process: one event loop for the worker's whole life,
+    # so resolver limits, pooled TCP connections and the ranking carry over
+    # from shard to shard, and the next shard's domains start as soon as
+    # slots free up instead of after the previous shard's slowest lookup.
+    pin_worker(index)
+    try:
+        run(resolve_worker_loop(shards, results, resolvers, record_types, options))
+    except BaseException as e:
+        results.put(e)
+    else:
+        results.put(None)  # this worker is done
+
+async def resolve_worker_loop(shards, results, resolvers, record_types, options):
+    loop = asyncio.get_running_loop()
 
-    return list(results.values())
+    async def domains():
+        while True:
+            shard = await loop.run_in_executor(None, shards.get)
+            if shard is None:
+                return
+            for domain in shard:
+                yield domain
 
-def print_results(results, record_types):
-    for r in results:
-        print(f"\n{r['domain']}")
-        for rtype in record_types:
-            if rtype in r:
-                print(f"  {rtype:<4}: {r[rtype]}")
+    batch = []
+    async for record in resolve_records(domains(), resolvers, record_types, **options):
+        batch.append(record)
+        if len(batch) >= RESULT_BATCH:
+            results.put(batch)
+            batch = []
+    if batch:
+        results.put(batch)
 
-def write_csv(results, record_types, filename="diglet_output.csv"):
+def next_batch(results, workers):
+    # Blocks for the next message from the workers, but notices when they
+    # have all died without reporting back (e.g. killed by the OOM killer).
+    while True:
+        try:
+            return results.get(timeout=1.0)
+        except queue.Empty:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError("worker processes exited unexpectedly")
+
+async def resolve_sharded(domains, resolvers, record_types, processes, **options):
+    # Worker processes pull SHARD_SIZE domains at a time from a shared queue,
+    # so parsing and formatting are no longer confined to a single core and
+    # a worker stuck on slow domains does not hold up the others.
+    options["max_workers"] = max(1, options.get("max_workers", 1000) // processes)
+    if options.get("rank"):
+        # Probe once here and hand the ranking to every worker, rather than
+        # having each of them probe all resolvers again.
+        ranking = ResolverRanking(resolvers, options["rank"])
+        transport = DNSTransport()
+        try:
+            await ranking.probe(transport, options.get("timeout", 1.0))
+        finally:
+            transport.close()
+        options["ranking"] = ranking
+    shards = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=resolve_worker, daemon=True,
+                                       args=(index, shards, results, resolvers, record_types, options))
+               for index in range(processes)]
+    # Fork the workers before the first put() starts the queue's feeder
+    # thread: forking a multi-threaded process can deadlock the child.
+    for worker in workers:
+        worker.start()
+    for i in range(0, len(domains), SHARD_SIZE):
+        shards.put(domains[i:i + SHARD_SIZE])
+    for _ in range(processes):
+        shards.put(None)
+    loop = asyncio.get_running_loop()
+    try:
+        remaining = processes
+        while remaining:
+            batch = await loop.run_in_executor(None, next_batch, results, workers)
+            if batch is None:
+                remaining -= 1
+            elif isinstance(batch, BaseException):
+                raise batch
+            else:
+                for record in batch:
+                    yield record
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+async def print_results(results, record_types):
+    # One write per domain: a terminal flushes once per record, not per line
+    async for r in results:
+        lines = [f"\n{r['domain']}"]
+        lines.extend(f"  {rtype:<4}: {r[rtype]}" for rtype in record_types if rtype in r)
+        sys.stdout.write("\n".join(lines) + "\n")
+
+async def print_jsonl(results):
+    # One JSON object per line; orjson, when installed, serializes straight to bytes
+    if orjson is not None:
+        async for r in results:
+            sys.stdout.buffer.write(orjson.dumps(r) + b"\n")
+    else:
+        async for r in results:
+            sys.stdout.write(json.dumps(r) + "\n")
+
+async def write_csv(results, record_types, filename="diglet_output.csv"):
     with open(filename, "w", newline='') as f:
         writer = csv.writer(f)
         writer.writerow(["domain"] + record_types)
-        for r in results:
+        async for r in results:
             row = [r["domain"]]
             for rtype in record_types:
                 row.append("; ".join(r.get(rtype, [])))
             writer.writerow(row)
 
+async def discard(results):
+    async for _ in results:
+        pass
+
+def run(coro):
+    if uvloop is not None:
+        uvloop.install()
+    return asyncio.run(coro)
+
 def main():
     args = parse_args()
     domains = load_list(args.domains)
-    resolvers = load_list(args.resolvers)
-    record_types = [rtype.strip().upper() for rtype in args.types.split(",")]
-    results = resolve_records(domains, resolvers, record_types, max_workers=args.workers)
+    try:
+        resolvers = load_resolvers(args.resolvers)
+    except ValueError as e:
+        sys.exit(f"diglet: {e}")
+    # Ordered and unique: the order drives output columns, and a domain's
+    # record is complete once it holds every distinct type.
+    record_types = list(dict.fromkeys(rtype.strip().upper() for rtype in args.types.split(",") if rtype.strip()))
+    options = dict(max_workers=args.workers, max_retries=args.retries, timeout=args.timeout, replicate=args.replicate,
+                   rank=args.rank, reprobe_interval=args.reprobe_interval)
+    if args.processes > 1:
+        results = resolve_sharded(domains, resolvers, record_types, args.processes, **options)
+    else:
+        results = resolve_records(domains, resolvers, record_types, **options)
 
     if args.output:
-        write_csv(results, record_types, filename=args.output)
-    elif not args.quiet:
-        print_results(results, record_types)
+        run(write_csv(results, record_types, filename=args.output))
+    elif args.quiet:
+        run(discard(results))
+    elif args.format == "jsonl":
+        run(print_jsonl(results))
+    else:
+        run(print_results(results, record_types))
 
 if __name__ == "__main__":
     main()
-
@@ -0,0 +1,219 @@
+import asyncio
+import contextlib
+import random
+import socket
+import struct
+import time
+
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.rrset
+import pytest
+
+import diglet
+
+
+def answer(query):
+    # A for 192.0.2.1, or a TXT record holding the query name, so a reply can
+    # be told apart from the replies to other queries.
+    name = query.question[0].name
+    response = dns.message.make_response(query)
+    if query.question[0].rdtype == dns.rdatatype.TXT:
+        response.answer.append(dns.rrset.from_text(name, 300, "IN", "TXT", f'"{name}"'))
+    else:
+        response.answer.append(dns.rrset.from_text(name, 300, "IN", "A", "192.0.2.1"))
+    return response
+
+
+class FakeResolver(asyncio.DatagramProtocol):
+    # Answers after a LAN-ish round trip, except for names starting with
+    # "dead", which it never answers at all, and names starting with "big",
+    # which only get a truncated reply. Given an rcode, it instead replies
+    # with that rcode straight away.
+    def __init__(self, rcode=None):
+        self.rcode = rcode
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = dns.message.from_wire(data)
+        name = query.question[0].name
+        if self.rcode is not None:
+            response = dns.message.make_response(query)
+            response.set_rcode(self.rcode)
+            self.transport.sendto(response.to_wire(), addr)
+            return
+        if name.labels[0].startswith(b"dead"):
+            return
+        if name.labels[0].startswith(b"big"):
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.TC
+        else:
+            response = answer(query)
+        asyncio.get_running_loop().call_later(0.02, self.transport.sendto, response.to_wire(), addr)
+
+
+async def serve_tcp(reader, writer):
+    # Pipelined DNS over TCP: every query is answered as soon as it is read,
+    # after a random delay, so replies come back out of order.
+    async def reply(query):
+        await asyncio.sleep(random.uniform(0, 0.02))
+        wire = answer(query).to_wire()
+        writer.write(struct.pack("!H", len(wire)) + wire)
+
+    replies = set()
+    try:
+        while True:
+            length, = struct.unpack("!H", await reader.readexactly(2))
+            job = asyncio.create_task(reply(dns.message.from_wire(await reader.readexactly(length))))
+            replies.add(job)
+            job.add_done_callback(replies.discard)
+    except asyncio.IncompleteReadError:
+        pass
+    finally:
+        for job in replies:
+            job.cancel()
+        writer.close()
+
+
+@contextlib.asynccontextmanager
+async def fake_resolvers(*rcodes):
+    # One fake resolver, UDP and TCP on the same port, per entry in `rcodes`
+    loop = asyncio.get_running_loop()
+    servers = []
+    resolvers = []
+    try:
+        for rcode in rcodes:
+            tcp = await asyncio.start_server(serve_tcp, "127.0.0.1", 0)
+            servers.append(tcp)
+            resolver = tcp.sockets[0].getsockname()
+            udp, _ = await loop.create_datagram_endpoint(lambda: FakeResolver(rcode), local_addr=resolver)
+            servers.append(udp)
+            resolvers.append(resolver)
+        yield resolvers
+    finally:
+        for server in servers:
+            server.close()
+
+
+async def collect(results):
+    return [r async for r in results]
+
+
+async def resolve(domains, rcodes=(None,), **options):
+    async with fake_resolvers(*rcodes) as resolvers:
+        return await collect(diglet.resolve_records(domains, resolvers, ["A"], **options))
+
+
+def test_dead_names_do_not_serialize_a_healthy_resolver():
+    # 30 names that never resolve, spread through 3000 that answer at once:
+    # their timeouts must not throttle the resolver down to a trickle.
+    domains = [f"dead{i}.example" if i % 100 == 0 else f"host{i}.example" for i in range(3000)]
+    start = time.monotonic()
+    records = asyncio.run(resolve(domains, timeout=0.2, max_retries=3))
+    elapsed = time.monotonic() - start
+
+    assert len(records) == len(domains)
+    for record in records:
+        expected = [] if record["domain"].startswith("dead") else ["192.0.2.1"]
+        assert record["A"] == expected
+    # About 4 s here; throttled to one query at a time it takes over 40 s
+    assert elapsed < 15
+
+
+def test_adaptive_limit_backs_off_on_failure_rate_only():
+    limit = diglet.AdaptiveLimit()
+    for i in range(diglet.AIMD_WINDOW * 4):
+        limit.record("timeout" if i % 10 == 0 else "answer", 0.01)
+    assert limit.limit >= diglet.RESOLVER_CONCURRENCY
+
+    for _ in range(diglet.AIMD_WINDOW * 20):
+        limit.record("timeout", None)
+        limit.last_decrease = 0.0  # skip the cooldown
+    assert limit.limit == diglet.RESOLVER_MIN_CONCURRENCY
+
+
+def test_refused_resolver_does_not_win_a_race():
+    domains = [f"host{i}.example" for i in range(200)]
+    records = asyncio.run(resolve(domains, rcodes=(dns.rcode.REFUSED, None), replicate=2, max_retries=1, timeout=0.5))
+    assert all(record["A"] == ["192.0.2.1"] for record in records)
+
+
+def test_refused_reply_rotates_to_the_next_resolver():
+    domains = [f"host{i}.example" for i in range(200)]
+    records = asyncio.run(resolve(domains, rcodes=(dns.rcode.REFUSED, None), max_retries=2, timeout=0.5))
+    assert all(record["A"] == ["192.0.2.1"] for record in records)
+
+
+def test_unusable_address_family_does_not_leak_slots(monkeypatch):
+    # With IPv6 disabled, every query to an IPv6 resolver fails at once; the
+    # run must still finish rather than stall once the limit's slots run out.
+    open_socket = diglet.open_socket
+
+    def ipv4_only(family):
+        if family == socket.AF_INET6:
+            raise OSError("Address family not supported by protocol")
+        return open_socket(family)
+
+    monkeypatch.setattr(diglet, "open_socket", ipv4_only)
+    domains = [f"host{i}.example" for i in range(diglet.RESOLVER_CONCURRENCY * 2)]
+
+    async def main():
+        results = diglet.resolve_records(domains, [("::1", 53)], ["A"], max_retries=1)
+        return await asyncio.wait_for(collect(results), 5)
+
+    records = asyncio.run(main())
+    assert len(records) == len(domains)
+
+
+def test_truncated_reply_falls_back_to_tcp():
+    records = asyncio.run(resolve(["big1.example", "host1.example"]))
+    assert all(record["A"] == ["192.0.2.1"] for record in records)
+
+
+def test_pipelined_tcp_replies_are_matched_to_their_queries():
+    names = [f"host{i}.example" for i in range(50)]
+
+    async def main():
+        async with fake_resolvers(None) as resolvers:
+            pool = diglet.TCPPool()
+            try:
+                queries = [diglet.make_query(name, "TXT") for name in names]
+                responses = await asyncio.gather(*(pool.query(request, wire, resolvers[0], 2) for request, wire in queries))
+                return responses, len(pool.connections)
+            finally:
+                pool.close()
+
+    responses, connections = asyncio.run(main())
+    assert connections == 1
+    for name, response in zip(names, responses):
+        assert [r.to_text() for r in response.answer[0]] == [f'"{name}."']
+
+
+def test_fetch_first_prefers_an_answer_over_nxdomain():
+    async def main():
+        async with fake_resolvers(dns.rcode.NXDOMAIN, None) as resolvers:
+            transport = diglet.DNSTransport()
+            try:
+                request, wire = diglet.make_query("host1.example", "A")
+                # The NXDOMAIN reply arrives first but must not win the race
+                raced = await diglet.fetch_first(transport, request, wire, resolvers, 1)
+                alone = await diglet.fetch_first(transport, request, wire, resolvers[:1], 1)
+                return raced, alone
+            finally:
+                transport.close()
+
+    assert asyncio.run(main()) == (["192.0.2.1"], "NXDOMAIN")
+
+
+def test_load_resolvers_accepts_ipv4_and_ipv6(tmp_path):
+    path = tmp_path / "resolvers.txt"
+    path.write_text("1.1.1.1\n0:0::1\n2620:FE::FE\n1.1.1.1\n")
+    assert diglet.load_resolvers(path) == [("1.1.1.1", 53), ("::1", 53), ("2620:fe::fe", 53)]
+
+    path.write_text("1.1.1.1\nresolver.example\n")
+    with pytest.raises(ValueError):
+        diglet.load_resolvers(path)